@@ -1,11 +1,11 @@
 import streamlit as st
 import pandas as pd
-import datetime
+import abc
+import functools
 import os
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
-from openai import OpenAI
 import json
+import re
+import shutil
 
 # ---------------------------------------------------
 # PAGE CONFIG
@@ -17,13 +17,23 @@ st.title("🚁 Skylark Drones Operations AI Agent")
 # OPENAI SETUP
 # ---------------------------------------------------
 api_key = os.getenv("OPENAI_API_KEY")
-client = OpenAI(api_key=api_key) if api_key else None
+
+
+@st.cache_resource
+def get_openai_client():
+    # Imported here so sessions that never reach the LLM don't pay for it.
+    from openai import OpenAI
+
+    return OpenAI(api_key=api_key)
 
 # ---------------------------------------------------
 # GOOGLE SHEETS CONNECTION
 # ---------------------------------------------------
 @st.cache_resource
 def connect_to_sheets():
+    import gspread
+    from oauth2client.service_account import ServiceAccountCredentials
+
     scope = [
         "https://spreadsheets.google.com/feeds",
         "https://www.googleapis.com/auth/drive"
@@ -35,101 +45,309 @@ def connect_to_sheets():
     )
     return gspread.authorize(creds)
 
-gc = connect_to_sheets()
 SPREADSHEET_NAME = "Skylark Drone Database"
+TABLES = ["pilot_roster", "drone_fleet", "missions"]
+# Data source selection:
+#   USE_CSV=1          read/write local CSVs instead of the Google Sheet.
+#   SKYLARK_DATA_DIR   where CSV mode keeps its working copies
+#                      (default ~/.skylark_drones).
+# The bundled CSVs are only seed data. Each one is copied into DATA_DIR on
+# first use and again whenever the bundled file is newer than the copy, which
+# replaces any status changes saved there. Delete DATA_DIR to reset.
+SEED_DIR = os.path.dirname(os.path.abspath(__file__))
+DATA_DIR = os.getenv("SKYLARK_DATA_DIR", os.path.join(os.path.expanduser("~"), ".skylark_drones"))
 
-def load_data():
-    sheet = gc.open(SPREADSHEET_NAME)
-    pilots = pd.DataFrame(sheet.worksheet("pilot_roster").get_all_records())
-    drones = pd.DataFrame(sheet.worksheet("drone_fleet").get_all_records())
-    missions = pd.DataFrame(sheet.worksheet("missions").get_all_records())
-    return pilots, drones, missions
 
-if "pilots" not in st.session_state:
-    st.session_state.pilots, st.session_state.drones, st.session_state.missions = load_data()
+@st.cache_resource
+def open_spreadsheet():
+    return connect_to_sheets().open(SPREADSHEET_NAME)
+
+# ---------------------------------------------------
+# TABLE PREPARATION
+# ---------------------------------------------------
+# Columns computed at load time; never written back to the source.
+DERIVED_COLUMNS = [
+    "skills_set", "certs_set", "required_skills_set", "required_certs_set",
+    "start_dt", "days", "weather_rainy", "maintenance_dt", "rain_ok",
+]
+
+
+def to_tag_set(series):
+    """Turn comma-separated cells into frozensets of stripped tags."""
+    return series.astype(str).str.split(",").apply(
+        lambda tags: frozenset(tag.strip() for tag in tags)
+    )
+
+
+def sheet_columns(df):
+    return df.drop(columns=DERIVED_COLUMNS, errors="ignore")
+
+
+def prepare_tables(pilots, drones, missions, date_format):
+    """Add the derived lookup columns shared by every data source."""
+
+    pilots["skills_set"] = to_tag_set(pilots["skills"])
+    pilots["certs_set"] = to_tag_set(pilots["certifications"])
+    missions["required_skills_set"] = to_tag_set(missions["required_skills"])
+    missions["required_certs_set"] = to_tag_set(missions["required_certs"])
+
+    missions["start_dt"] = pd.to_datetime(missions["start_date"], format=date_format, errors="coerce")
+    end_dt = pd.to_datetime(missions["end_date"], format=date_format, errors="coerce")
+    missions["days"] = (end_dt - missions["start_dt"]).dt.days + 1
+    missions["weather_rainy"] = missions["weather_forecast"].astype(str).str.lower().eq("rainy")
+    drones["maintenance_dt"] = pd.to_datetime(drones["maintenance_due"], format=date_format, errors="coerce")
+    drones["rain_ok"] = drones["weather_resistance"].astype(str).str.lower().str.contains("rain", na=False)
+
+    for df, columns in [
+        (pilots, ["status", "location"]),
+        (drones, ["status", "location"]),
+        (missions, ["location", "priority", "weather_forecast"]),
+    ]:
+        for col in columns:
+            df[col] = df[col].astype("category")
+
+    return pilots, drones, missions
 
 # ---------------------------------------------------
-# SYNC FUNCTION
+# DATA SOURCES
 # ---------------------------------------------------
-def sync_sheet(df, sheet_name):
-    sheet = gc.open(SPREADSHEET_NAME).worksheet(sheet_name)
-    sheet.clear()
-    sheet.update([df.columns.values.tolist()] + df.values.tolist())
+def frame_from_range(name, value_range):
+    """Build a DataFrame from one ``valueRanges`` entry (header row first)."""
+    header, *rows = value_range.get("values", [[]])
+    if not header:
+        raise ValueError(f"Worksheet '{name}' has no header row.")
+
+    width = len(header)
+    # Cells right of the header are ignored, as get_all_records did. Blank rows
+    # come back as [] (or short lists); skip rows with no values but keep each
+    # row's 1-based sheet row number as its index for write_cell.
+    rows = [row[:width] for row in rows]
+    kept = [(i + 2, row) for i, row in enumerate(rows) if any(cell != "" for cell in row)]
+    return pd.DataFrame(
+        [row + [""] * (width - len(row)) for _, row in kept],
+        index=[sheet_row for sheet_row, _ in kept],
+        columns=header,
+    )
+
+
+@st.cache_data(ttl=300, show_spinner=False)
+def load_sheets(date_format):
+    # One batched request instead of a round trip per worksheet.
+    resp = open_spreadsheet().values_batch_get(
+        [f"{name}!A:Z" for name in TABLES],
+        params={
+            "valueRenderOption": "UNFORMATTED_VALUE",
+            "dateTimeRenderOption": "FORMATTED_STRING",
+        },
+    )
+    frames = [
+        frame_from_range(name, r) for name, r in zip(TABLES, resp["valueRanges"])
+    ]
+    return prepare_tables(*frames, date_format)
+
+
+def csv_path(table):
+    """Path of ``table`` in DATA_DIR, refreshed from the seed CSV when that is newer."""
+    path = os.path.join(DATA_DIR, f"{table}.csv")
+    seed = os.path.join(SEED_DIR, f"{table}.csv")
+    if not os.path.exists(path) or os.path.getmtime(seed) > os.path.getmtime(path):
+        os.makedirs(DATA_DIR, exist_ok=True)
+        shutil.copyfile(seed, path)
+    return path
+
+
+@st.cache_data(persist="disk", show_spinner=False)
+def load_csvs(date_format, mtimes):
+    # ``mtimes`` is only part of the cache key, so edited files are re-read.
+    # The pyarrow engine only speeds up parsing. dtype_backend stays numpy so the
+    # frames match SheetsSource dtype for dtype once prepare_tables has run.
+    frames = [pd.read_csv(csv_path(name), engine="pyarrow") for name in TABLES]
+    return prepare_tables(*frames, date_format)
+
+
+class DataSource(abc.ABC):
+    """Where the pilot, drone and mission tables are read from and saved to."""
+
+    @abc.abstractmethod
+    def load(self):
+        """Return ``(pilots, drones, missions)`` with derived columns added."""
+
+    @abc.abstractmethod
+    def write_table(self, df, table):
+        """Rewrite a whole table from ``df``; only for explicit resyncs."""
+
+    @abc.abstractmethod
+    def write_cell(self, df, table, row_label, column):
+        """Persist a single changed cell of ``df``."""
+
+
+class SheetsSource(DataSource):
+
+    date_format = "%Y-%m-%d"
+
+    def load(self):
+        return load_sheets(self.date_format)
+
+    def write_table(self, df, table):
+        values = sheet_columns(df)
+        sheet = open_spreadsheet().worksheet(table)
+        sheet.clear()
+        sheet.update([values.columns.values.tolist()] + values.values.tolist())
+        # Rows are now packed below the header; keep the index as sheet rows.
+        df.index = range(2, len(df) + 2)
+        load_sheets.clear()
+
+    def write_cell(self, df, table, row_label, column):
+        # Frames from load_sheets are indexed by their sheet row number.
+        sheet = open_spreadsheet().worksheet(table)
+        col = sheet_columns(df).columns.get_loc(column) + 1
+        sheet.update_cell(row_label, col, df.at[row_label, column])
+        load_sheets.clear()
+
+
+class CSVSource(DataSource):
+
+    date_format = "%d-%m-%Y"
+
+    def load(self):
+        mtimes = tuple(os.path.getmtime(csv_path(name)) for name in TABLES)
+        return load_csvs(self.date_format, mtimes)
+
+    def write_table(self, df, table):
+        sheet_columns(df).to_csv(csv_path(table), index=False, lineterminator="\r\n")
+        load_csvs.clear()
+
+    def write_cell(self, df, table, row_label, column):
+        # A local file has no per-cell API; rewriting it is cheap.
+        self.write_table(df, table)
+
+
+data_source = CSVSource() if os.getenv("USE_CSV") else SheetsSource()
+
+
+def index_by(df, key):
+    """Map each ``key`` value to its first row as a plain dict."""
+    ids = df[key].astype(str).str.strip()
+    blank = df[key].isna() | ids.eq("")
+    duplicate = ~blank & ids.duplicated()
+
+    if blank.any():
+        st.warning(f"Ignoring {int(blank.sum())} row(s) with no {key}.")
+    if duplicate.any():
+        st.warning(f"Duplicate {key} values, using the first row for: {', '.join(sorted(set(ids[duplicate])))}")
+
+    return df[~blank & ~duplicate].set_index(key, drop=False).to_dict("index")
+
+
+def build_indexes():
+    st.session_state.pilots_idx = index_by(st.session_state.pilots, "pilot_id")
+    st.session_state.drones_idx = index_by(st.session_state.drones, "drone_id")
+    st.session_state.missions_idx = index_by(st.session_state.missions, "project_id")
+
+    missions = st.session_state.missions
+    st.session_state.standard_project_ids = set(
+        missions.loc[missions["priority"].eq("Standard"), "project_id"]
+    )
+
+if "pilots" not in st.session_state:
+    st.session_state.pilots, st.session_state.drones, st.session_state.missions = data_source.load()
+    build_indexes()
+    st.session_state.table_version = 0
+    st.session_state.result_cache = {}
+
+
+def bump_table_version():
+    """Mark the in-memory tables as changed and drop cached lookups."""
+    st.session_state.table_version += 1
+    st.session_state.result_cache = {}
+
+
+def cached_per_session(func):
+    """Memoize ``func`` in session state until the tables next change."""
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        key = (func.__name__, args, tuple(sorted(kwargs.items())), st.session_state.table_version)
+        cache = st.session_state.result_cache
+        if key not in cache:
+            cache[key] = func(*args, **kwargs)
+        return cache[key]
+
+    return wrapper
 
 # ---------------------------------------------------
 # BUSINESS LOGIC FUNCTIONS
 # ---------------------------------------------------
+@cached_per_session
 def check_conflicts(pilot_id, drone_id, project_id):
 
-    pilots = st.session_state.pilots
-    drones = st.session_state.drones
-    missions = st.session_state.missions
+    lookups = [
+        ("pilot", st.session_state.pilots_idx, pilot_id),
+        ("drone", st.session_state.drones_idx, drone_id),
+        ("project", st.session_state.missions_idx, project_id),
+    ]
+    for label, index, key in lookups:
+        if key not in index:
+            return [f"Unknown {label}: {key}"]
 
-    try:
-        pilot = pilots[pilots["pilot_id"] == pilot_id].iloc[0]
-        drone = drones[drones["drone_id"] == drone_id].iloc[0]
-        mission = missions[missions["project_id"] == project_id].iloc[0]
-    except:
-        return ["Invalid IDs provided."]
+    pilot = st.session_state.pilots_idx[pilot_id]
+    drone = st.session_state.drones_idx[drone_id]
+    mission = st.session_state.missions_idx[project_id]
 
     conflicts = []
 
     if pilot["status"] != "Available":
         conflicts.append(f"Pilot {pilot['name']} is currently {pilot['status']}.")
 
-    required_skills = [s.strip() for s in mission["required_skills"].split(",")]
-    pilot_skills = [s.strip() for s in pilot["skills"].split(",")]
-
-    if not all(skill in pilot_skills for skill in required_skills):
+    if not mission["required_skills_set"] <= pilot["skills_set"]:
         conflicts.append("Skill mismatch detected.")
 
-    required_certs = str(mission["required_certs"]).split(",")
-    pilot_certs = str(pilot["certifications"]).split(",")
-
-    if not all(cert.strip() in pilot_certs for cert in required_certs):
+    if not mission["required_certs_set"] <= pilot["certs_set"]:
         conflicts.append("Certification mismatch detected.")
 
     if pilot["location"] != mission["location"]:
         conflicts.append("Location mismatch.")
 
-    start = datetime.datetime.strptime(mission["start_date"], "%Y-%m-%d")
-    end = datetime.datetime.strptime(mission["end_date"], "%Y-%m-%d")
-    days = (end - start).days + 1
-    total_cost = days * float(pilot["daily_rate_inr"])
+    if mission["weather_rainy"] and not drone["rain_ok"]:
+        conflicts.append("Drone not rated for rainy weather.")
+
+    if pd.isna(mission["days"]) or pd.isna(drone["maintenance_dt"]):
+        conflicts.append("Invalid mission or maintenance dates.")
+        return conflicts
+
+    total_cost = mission["days"] * float(pilot["daily_rate_inr"])
 
     if total_cost > float(mission["mission_budget_inr"]):
         conflicts.append(f"Budget overrun: ₹{total_cost}")
 
-    if mission["weather_forecast"].lower() == "rainy":
-        if "rain" not in str(drone["weather_resistance"]).lower():
-            conflicts.append("Drone not rated for rainy weather.")
-
-    maint = datetime.datetime.strptime(drone["maintenance_due"], "%Y-%m-%d")
-    if maint <= start:
+    if drone["maintenance_dt"] <= mission["start_dt"]:
         conflicts.append("Drone maintenance due before mission.")
 
     return conflicts
 
 
+@cached_per_session
 def handle_urgent_reassignment(project_id):
 
-    missions = st.session_state.missions
     pilots = st.session_state.pilots
 
-    try:
-        mission = missions[missions["project_id"] == project_id].iloc[0]
-    except:
+    if project_id not in st.session_state.missions_idx:
         return "Invalid project ID."
 
+    mission = st.session_state.missions_idx[project_id]
+
     if mission["priority"].lower() != "urgent":
         return "Mission is not marked as Urgent."
 
-    assigned = pilots[pilots["status"] == "Assigned"]
+    candidates = pilots[
+        pilots["status"].eq("Assigned")
+        & pilots["current_assignment"].isin(st.session_state.standard_project_ids)
+    ].head(1)
 
-    if assigned.empty:
+    if candidates.empty:
         return "No pilots available for reassignment."
 
-    suggested = assigned.iloc[0]
+    suggested = candidates.iloc[0]
 
     return f"Suggested: Reassign Pilot {suggested['name']} from {suggested['current_assignment']} to {project_id}"
 
@@ -141,16 +359,170 @@ def update_pilot_status(pilot_id, new_status):
     ].tolist()
 
     if idx:
-        st.session_state.pilots.at[idx[0], "status"] = new_status
-        sync_sheet(st.session_state.pilots, "pilot_roster")
+        pilots = st.session_state.pilots
+        if new_status not in pilots["status"].cat.categories:
+            pilots["status"] = pilots["status"].cat.add_categories([new_status])
+        pilots.at[idx[0], "status"] = new_status
+        st.session_state.pilots_idx[pilot_id]["status"] = new_status
+        bump_table_version()
+        data_source.write_cell(st.session_state.pilots, "pilot_roster", idx[0], "status")
         return f"Pilot {pilot_id} updated to {new_status}"
 
     return "Pilot not found."
 
 
+# ---------------------------------------------------
+# LLM AGENT
+# ---------------------------------------------------
+SYSTEM_PROMPT = (
+    "You are the operations coordinator for Skylark Drones. "
+    "Answer questions about pilots, drones and missions using the records below, "
+    "and call the provided tools to check conflicts, suggest urgent reassignments "
+    "or update pilot status."
+)
+
+MAX_AGENT_STEPS = 5
+ROUTER_MODEL = os.getenv("ROUTER_MODEL", "gpt-4o-mini")
+
+TOOLS = [
+    {
+        "type": "function",
+        "function": {
+            "name": "check_conflicts",
+            "description": "List conflicts for assigning a pilot and drone to a mission.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "pilot_id": {"type": "string"},
+                    "drone_id": {"type": "string"},
+                    "project_id": {"type": "string"},
+                },
+                "required": ["pilot_id", "drone_id", "project_id"],
+            },
+        },
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "handle_urgent_reassignment",
+            "description": "Suggest a pilot to reassign to an urgent mission.",
+            "parameters": {
+                "type": "object",
+                "properties": {"project_id": {"type": "string"}},
+                "required": ["project_id"],
+            },
+        },
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "update_pilot_status",
+            "description": "Set a pilot's status and save it to the roster sheet.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "pilot_id": {"type": "string"},
+                    "new_status": {"type": "string"},
+                },
+                "required": ["pilot_id", "new_status"],
+            },
+        },
+    },
+]
+TOOL_HANDLERS = {
+    "check_conflicts": check_conflicts,
+    "handle_urgent_reassignment": handle_urgent_reassignment,
+    "update_pilot_status": update_pilot_status,
+}
+
+ID_PATTERN = re.compile(r"\b(PRJ\d+|P\d+|D\d+)\b", re.IGNORECASE)
+
+
+def build_context(user_input):
+    """Return only the rows referenced in ``user_input``; schema summary otherwise."""
+
+    ids = {match.upper() for match in ID_PATTERN.findall(user_input)}
+    tables = [
+        ("pilot_roster", st.session_state.pilots, "pilot_id"),
+        ("drone_fleet", st.session_state.drones, "drone_id"),
+        ("missions", st.session_state.missions, "project_id"),
+    ]
+
+    sections = []
+    for name, df, key in tables:
+        df = sheet_columns(df)
+        rows = df[df[key].isin(ids)] if ids else df.iloc[0:0]
+        if rows.empty:
+            sections.append(f"{name} ({len(df)} rows) columns: {', '.join(df.columns)}")
+        else:
+            sections.append(f"{name}:\n{rows.to_csv(index=False)}")
+
+    return "\n\n".join(sections)
+
+
+def run_agent(messages):
+    """Yield the model's reply, running any tool calls locally between turns."""
+
+    for _ in range(MAX_AGENT_STEPS):
+        stream = get_openai_client().chat.completions.create(
+            model=ROUTER_MODEL,
+            messages=messages,
+            tools=TOOLS,
+            parallel_tool_calls=True,
+            stream=True,
+        )
+
+        text = []
+        calls = {}
+        for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta
+            if delta.content:
+                text.append(delta.content)
+                yield delta.content
+            for call in delta.tool_calls or []:
+                entry = calls.setdefault(call.index, {"id": "", "name": "", "arguments": ""})
+                entry["id"] = call.id or entry["id"]
+                if call.function:
+                    entry["name"] += call.function.name or ""
+                    entry["arguments"] += call.function.arguments or ""
+
+        if not calls:
+            return
+
+        messages.append({
+            "role": "assistant",
+            "content": "".join(text) or None,
+            "tool_calls": [
+                {
+                    "id": call["id"],
+                    "type": "function",
+                    "function": {"name": call["name"], "arguments": call["arguments"]},
+                }
+                for call in calls.values()
+            ],
+        })
+        for call in calls.values():
+            handler = TOOL_HANDLERS.get(call["name"])
+            try:
+                args = json.loads(call["arguments"] or "{}")
+                result = handler(**args) if handler else f"Unknown tool: {call['name']}"
+            except Exception as exc:
+                # Hand the failure back to the model instead of losing the reply.
+                result = f"Error running {call['name']}: {exc}"
+            messages.append({"role": "tool", "tool_call_id": call["id"], "content": str(result)})
+
+    yield "\n\nStopped after too many tool calls."
+
+
 # ---------------------------------------------------
 # CHAT UI
 # ---------------------------------------------------
+CONFLICT_RE = re.compile(r"\bpilot\s+(\w+).*?\bdrone\s+(\w+).*?\bproject\s+(\w+)", re.IGNORECASE)
+URGENT_RE = re.compile(r"urgent.*?(\w+)\W*$", re.IGNORECASE)
+UPDATE_RE = re.compile(r"\bupdate\s+(?:pilot\s+)?(\w+)\b.*?\bto\s+(.+?)\s*$", re.IGNORECASE)
+
 if "messages" not in st.session_state:
     st.session_state.messages = [
         {"role": "assistant", "content": "Hello! I manage pilots, drones and missions. How can I help?"}
@@ -171,29 +543,39 @@ if user_input:
     text = user_input.lower()
 
     if "conflict" in text:
-        words = user_input.split()
-        if len(words) >= 7:
-            pilot_id = words[4]
-            drone_id = words[6]
-            project_id = words[8]
-            result = check_conflicts(pilot_id, drone_id, project_id)
+        match = CONFLICT_RE.search(user_input)
+        if match:
+            result = check_conflicts(*match.groups())
             response = result if result else ["No conflicts detected. Safe to assign."]
         else:
             response = ["Please provide pilot_id, drone_id, and project_id."]
 
     elif "urgent" in text:
-        words = user_input.split()
-        project_id = words[-1]
-        response = handle_urgent_reassignment(project_id)
+        match = URGENT_RE.search(user_input)
+        response = handle_urgent_reassignment(match.group(1)) if match else "Please provide a project_id."
 
     elif "update" in text:
-        words = user_input.split()
-        pilot_id = words[2]
-        new_status = words[-1]
-        response = update_pilot_status(pilot_id, new_status)
+        match = UPDATE_RE.search(user_input)
+        if match:
+            response = update_pilot_status(*match.groups())
+        else:
+            response = "Please use: update pilot <pilot_id> to <status>."
+
+    elif api_key:
+        # Answered below by streaming straight into the chat bubble.
+        response = None
 
     else:
         response = "Please ask about conflicts, urgent reassignment, or status updates."
 
-    st.session_state.messages.append({"role": "assistant", "content": str(response)})
-    st.rerun()
\ No newline at end of file
+    with st.chat_message("assistant"):
+        if response is None:
+            messages = [
+                {"role": "system", "content": f"{SYSTEM_PROMPT}\n\n{build_context(user_input)}"}
+            ] + st.session_state.messages
+            response = st.write_stream(run_agent(messages))
+        else:
+            response = str(response)
+            st.write(response)
+
+    st.session_state.messages.append({"role": "assistant", "content": response})
\ No newline at end of file